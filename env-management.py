@@ -1,62 +1,186 @@
 #!/usr/bin/env python
 
 import argparse
+import contextlib
 import yaml
 import json
 import logging
+import logging.handlers
+import mmap
 import os
+import stat
 import time
 import sys
+import tempfile
+
+from concurrent.futures import ThreadPoolExecutor
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
 
 from cloudify_rest_client.client import CloudifyClient
 from cloudify_rest_client.executions import Execution
 
-logging.basicConfig(level=logging.INFO, stream=sys.stderr)
+
+class _BatchingStreamHandler(logging.handlers.BufferingHandler):
+    """Writes records straight through, except inside buffered(), where they are written out in one go."""
+
+    def __init__(self, stream, capacity):
+        logging.handlers.BufferingHandler.__init__(self, capacity)
+        self.stream = stream
+        self.buffering = False
+
+    def shouldFlush(self, record):
+        return not self.buffering or record.levelno >= logging.ERROR or len(self.buffer) >= self.capacity
+
+    def flush(self):
+        self.acquire()
+        try:
+            if not self.buffer:
+                return
+            # Like StreamHandler, report records that fail to format or write and carry on with the rest.
+            lines = []
+            for record in self.buffer:
+                try:
+                    lines.append(self.format(record) + '\n')
+                except Exception:
+                    self.handleError(record)
+            try:
+                self.stream.write(''.join(lines))
+                self.stream.flush()
+            except Exception:
+                self.handleError(self.buffer[-1])
+        finally:
+            self.buffer = []
+            self.release()
+
+    @contextlib.contextmanager
+    def buffered(self):
+        self.buffering = True
+        try:
+            yield
+        finally:
+            self.buffering = False
+            self.flush()
+
+
+_log_handler = _BatchingStreamHandler(sys.stderr, capacity=256)
+logging.basicConfig(level=logging.INFO, handlers=[_log_handler])
 logger = logging.getLogger(__name__)
 
+_LEVELS = {name.lower(): getattr(logging, name) for name in ('DEBUG', 'INFO', 'WARNING', 'ERROR', 'CRITICAL')}
+
 THIS_DIR = os.path.dirname(__file__)
+MANAGERS_FILE = os.path.join(THIS_DIR, 'managers.yaml')
+MANAGERS_CACHE_FILE = MANAGERS_FILE + '.cache.json'
+EVENTS_PAGE_SIZE = 1000
+POLL_MIN_DELAY = 0.1
+POLL_MAX_DELAY = 2.0
+EVENTS_FETCH_WORKERS = 4
+# Only the event fields used when logging them.
+EVENT_FIELDS = ['reported_timestamp', 'level', 'message', 'node_instance_id']
+
+
+def _list_events(client, execution_id, offset, include_logs):
+    return client.events.list(
+        execution_id=execution_id,
+        _offset=offset,
+        _size=EVENTS_PAGE_SIZE,
+        _include=EVENT_FIELDS,
+        include_logs=include_logs,
+        sort='reported_timestamp'
+    )
 
 
-def follow_execution(client, execution):
+def _list_event_pages(client, execution_id, offset, include_logs):
+    first_page = _list_events(client, execution_id, offset, include_logs)
+    pages = [first_page]
+    next_offset = offset + len(first_page.items)
+    total = first_page.metadata.pagination.total
+    # When far behind (e.g. following a long-running execution), fetch the backlog concurrently.
+    if len(first_page.items) == EVENTS_PAGE_SIZE and total - next_offset > 2 * EVENTS_PAGE_SIZE:
+        offsets = range(next_offset, total, EVENTS_PAGE_SIZE)
+        with ThreadPoolExecutor(max_workers=EVENTS_FETCH_WORKERS) as executor:
+            pages.extend(executor.map(lambda page_offset: _list_events(client, execution_id, page_offset, include_logs),
+                                      offsets))
+    return pages
+
+
+def follow_execution(client, execution, include_logs=True):
     logger.info(
         "Beginning to follow execution: id=%s, workflow=%s%s",
         execution.id,
         execution.workflow_id,
         ", deployment=%s" % execution.deployment_id if execution.deployment_id else "")
+    end_states = frozenset(Execution.END_STATES)
+    log = logger.log
+    is_enabled_for = logger.isEnabledFor
     offset = 0
     execution_ended = False
-    while True:
-        events_list_response = client.events.list(
-            execution_id=execution.id,
-            _offset=offset,
-            _size=500,
-            include_logs=True,
-            sort='reported_timestamp'
-        )
-        for item in events_list_response.items:
-            logger.log(
-                getattr(logging, item.get('level', 'info').upper()),
-                "[%s] [%s] %s%s",
-                item['reported_timestamp'],
-                execution.deployment_id,
-                "[%s] " % item['node_instance_id'] if item.get('node_instance_id', None) else '',
-                item['message'])
-
-        offset += len(events_list_response.items)
-        # If more events may be available - get them.
-        if offset < events_list_response.metadata.pagination.total:
-            continue
-        # If it already ended in the previous iteration, time to leave.
-        if execution_ended:
-            break
-        # Check the status of the execution.
-        execution = client.executions.get(execution.id, _include=['id', 'status', 'deployment_id', 'workflow_id'])
-        # If the execution status is still 'started', then we should continue for sure, after waiting for a second
-        # (to avoid unnecessary spins). If it's in an end state, then repeat the loop without wait.
-        if execution.status in Execution.END_STATES:
-            execution_ended = True
-        else:
-            time.sleep(1)
+    caught_up = False
+    delay = POLL_MIN_DELAY
+    with ThreadPoolExecutor(max_workers=1) as status_executor:
+        while True:
+            previous_offset = offset
+            # Once caught up on events, check the status while the next events are being fetched, rather than after.
+            status_future = None
+            if caught_up and not execution_ended:
+                status_future = status_executor.submit(
+                    client.executions.get, execution.id, _include=['id', 'status', 'deployment_id', 'workflow_id'])
+            pages = _list_event_pages(client, execution.id, offset, include_logs)
+            deployment_id = execution.deployment_id
+            for events_list_response in pages:
+                # Write each page's events out in one go rather than one write per event.
+                with _log_handler.buffered():
+                    for item in events_list_response.items:
+                        level = _LEVELS.get(item.get('level', 'info').lower(), logging.INFO)
+                        if not is_enabled_for(level):
+                            continue
+                        node_instance_id = item.get('node_instance_id')
+                        log(
+                            level,
+                            "[%s] [%s] %s%s",
+                            item['reported_timestamp'],
+                            deployment_id,
+                            "[%s] " % node_instance_id if node_instance_id else '',
+                            item['message'])
+                offset += len(events_list_response.items)
+
+            last_page = pages[-1]
+            # New events mean the execution is active; poll eagerly again.
+            if offset > previous_offset:
+                delay = POLL_MIN_DELAY
+            # If more events may be available - get them.
+            caught_up = offset >= last_page.metadata.pagination.total
+            if not caught_up:
+                # Keep a status fetched alongside these events; the events that follow it are still to be drained.
+                if status_future is not None:
+                    execution = status_future.result()
+                    execution_ended = execution.status in end_states
+                continue
+            # If it already ended in the previous iteration, time to leave.
+            if execution_ended:
+                break
+            # Check the status of the execution.
+            if status_future is not None:
+                execution = status_future.result()
+            else:
+                execution = client.executions.get(
+                    execution.id, _include=['id', 'status', 'deployment_id', 'workflow_id'])
+            # If the execution status is still 'started', then we should continue for sure, after backing off
+            # (to avoid unnecessary spins). If it's in an end state, then repeat the loop without wait.
+            if execution.status in end_states:
+                execution_ended = True
+            else:
+                time.sleep(delay)
+                delay = min(delay * 1.5, POLL_MAX_DELAY)
 
     if execution_ended:
         logger.info("Finished following execution of '%s' for deployment '%s'", execution.workflow_id,
@@ -70,19 +194,73 @@ def follow_execution(client, execution):
     return execution
 
 
+def _load_yaml(path):
+    # Let the parser read straight from a memory map rather than a Python-level copy of the file.
+    with open(path, 'rb') as f:
+        st = os.fstat(f.fileno())
+        # Pipes and other special files can't be mapped and report a size of 0; read them normally.
+        if not stat.S_ISREG(st.st_mode):
+            return yaml.load(f, Loader=SafeLoader)
+        if st.st_size == 0:
+            return None
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            return yaml.load(mm, Loader=SafeLoader)
+        finally:
+            mm.close()
+
+
+def _load_managers():
+    # Parsing YAML is slow; keep a JSON copy of managers.yaml, invalidated by the YAML's mtime and size.
+    st = os.stat(MANAGERS_FILE)
+    key = [st.st_mtime_ns, st.st_size]
+    try:
+        with open(MANAGERS_CACHE_FILE) as f:
+            cached = json.load(f)
+        if isinstance(cached, dict) and cached.get('key') == key:
+            return cached['managers']
+    except (IOError, OSError, ValueError):
+        pass
+
+    managers = _load_yaml(MANAGERS_FILE)
+    # Only cache what JSON reproduces exactly (no dates, sets, non-string keys, ...).
+    try:
+        serialized = json.dumps({'key': key, 'managers': managers})
+        cacheable = json.loads(serialized)['managers'] == managers
+    except (TypeError, ValueError):
+        cacheable = False
+    if not cacheable:
+        return managers
+
+    # The cache holds the same credentials as managers.yaml: create it owner-only (mkstemp uses 0600) and
+    # move it into place atomically, so concurrent runs never read a partially written file.
+    try:
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(MANAGERS_CACHE_FILE) or '.', suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(serialized)
+            os.replace(tmp_path, MANAGERS_CACHE_FILE)
+        except BaseException:
+            os.remove(tmp_path)
+            raise
+    except (IOError, OSError):
+        logger.debug("Unable to write managers cache to %s", MANAGERS_CACHE_FILE)
+    return managers
+
+
 def _get_rest_client(managers, manager_id):
     manager_desc = managers['managers'][manager_id]
     return CloudifyClient(**manager_desc)
 
 
-def _create_deployment(client, blueprint_id, deployment_id, inputs):
+def _create_deployment(client, blueprint_id, deployment_id, inputs, include_logs=True):
     client.deployments.create(
         blueprint_id=blueprint_id,
         deployment_id=deployment_id,
         inputs=inputs)
     # Wait for deployment to finish (CYBL-955 would save this REST call).
     dep_execution = client.executions.list(deployment_id=deployment_id)[0]
-    follow_execution(client, dep_execution)
+    follow_execution(client, dep_execution, include_logs)
 
 
 def _delete_deployment(client, deployment_id):
@@ -98,47 +276,76 @@ def _delete_deployment(client, deployment_id):
             time.sleep(1)
 
 
-def _install(client, deployment_id):
+def _install(client, deployment_id, include_logs=True):
     install_execution = client.executions.start(
         deployment_id=deployment_id,
         workflow_id='install'
     )
-    follow_execution(client, install_execution)
+    follow_execution(client, install_execution, include_logs)
 
 
-def _uninstall(client, deployment_id):
+def _uninstall(client, deployment_id, include_logs=True):
     uninstall_execution = client.executions.start(
         deployment_id=deployment_id,
         workflow_id='uninstall'
     )
-    follow_execution(client, uninstall_execution)
+    follow_execution(client, uninstall_execution, include_logs)
+
+
+def _load_inputs(inputs_file):
+    # JSON is preferred (and much faster to parse); YAML is still accepted for '.yaml'/'.yml' files.
+    with open(inputs_file, 'r') as f:
+        try:
+            return json.load(f)
+        except ValueError as e:
+            if os.path.splitext(inputs_file)[1].lower() not in ('.yaml', '.yml'):
+                raise Exception("Inputs file '%s' is not valid JSON (%s); use a '.json' file, or a '.yaml'/'.yml' "
+                                "extension for YAML inputs" % (inputs_file, e))
+    return _load_yaml(inputs_file)
+
+
+def _write_json(path, obj):
+    # orjson only indents by two spaces; json uses the same so the file never depends on which one ran.
+    if orjson is not None:
+        try:
+            data = orjson.dumps(obj, option=orjson.OPT_INDENT_2)
+        except TypeError:
+            # Values orjson rejects but json accepts, e.g. integers wider than 64 bits or non-string keys.
+            pass
+        else:
+            with open(path, 'wb') as f:
+                f.write(data)
+            return
+    with open(path, 'w') as f:
+        json.dump(obj, f, indent=2)
 
 
-def create(managers, blueprint_id, env_deployment_id, inputs_file, outputs_file, **kwargs):
+def create(managers, blueprint_id, env_deployment_id, inputs_file, outputs_file, include_logs=True, **kwargs):
     manager_id = managers['topologies'][blueprint_id]
     client = _get_rest_client(managers, manager_id)
-    with open(inputs_file, 'r') as f:
-        inputs = yaml.safe_load(f)
-    _create_deployment(client, blueprint_id, env_deployment_id, inputs)
-    _install(client, env_deployment_id)
-    capabilities = client.deployments.capabilities.get(env_deployment_id)
-    outputs = client.deployments.outputs.get(env_deployment_id)
-    with open(outputs_file, 'w') as f:
-        json.dump({
-            'manager_id': manager_id,
-            'deployment_id': env_deployment_id,
-            'outputs': outputs.outputs,
-            'capabilities': capabilities.capabilities
-        }, f, indent=4)
-
-
-def delete(managers, manager_id, env_deployment_id, **kwargs):
+    inputs = _load_inputs(inputs_file)
+    _create_deployment(client, blueprint_id, env_deployment_id, inputs, include_logs)
+    _install(client, env_deployment_id, include_logs)
+    # Independent calls; fetch them side by side.
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        capabilities_future = executor.submit(client.deployments.capabilities.get, env_deployment_id)
+        outputs_future = executor.submit(client.deployments.outputs.get, env_deployment_id)
+        capabilities, outputs = capabilities_future.result(), outputs_future.result()
+    _write_json(outputs_file, {
+        'manager_id': manager_id,
+        'deployment_id': env_deployment_id,
+        'outputs': outputs.outputs,
+        'capabilities': capabilities.capabilities
+    })
+
+
+def delete(managers, manager_id, env_deployment_id, include_logs=True, **kwargs):
     client = _get_rest_client(managers, manager_id)
-    _uninstall(client, env_deployment_id)
+    _uninstall(client, env_deployment_id, include_logs)
     _delete_deployment(client, env_deployment_id)
 
 
-def install(managers, manager_id, app_blueprint_path, app_id, inputs_file, **kwargs):
+def install(managers, manager_id, app_blueprint_path, app_id, inputs_file, include_logs=True, **kwargs):
     client = _get_rest_client(managers, manager_id)
     client.blueprints.upload(
         path=app_blueprint_path,
@@ -146,29 +353,34 @@ def install(managers, manager_id, app_blueprint_path, app_id, inputs_file, **kwa
     )
     with open(inputs_file, 'r') as f:
         inputs = json.load(f)
-    _create_deployment(client, app_id, app_id, inputs)
-    _install(client, app_id)
+    _create_deployment(client, app_id, app_id, inputs, include_logs)
+    _install(client, app_id, include_logs)
 
 
-def uninstall(managers, manager_id, app_id, **kwargs):
+def uninstall(managers, manager_id, app_id, include_logs=True, **kwargs):
     client = _get_rest_client(managers, manager_id)
-    _uninstall(client, app_id)
+    _uninstall(client, app_id, include_logs)
     _delete_deployment(client, app_id)
     client.blueprints.delete(app_id)
 
 
 def main():
-    common_env_parser = argparse.ArgumentParser(add_help=False)
+    common_parser = argparse.ArgumentParser(add_help=False)
+    common_parser.add_argument('--no-logs', dest='include_logs', action='store_false',
+                               help="only show workflow events, not the logs emitted by operations")
+
+    common_env_parser = argparse.ArgumentParser(add_help=False, parents=[common_parser])
     common_env_parser.add_argument('--id', dest='env_deployment_id', metavar='ID', required=True)
 
-    common_app_parser = argparse.ArgumentParser(add_help=False)
+    common_app_parser = argparse.ArgumentParser(add_help=False, parents=[common_parser])
     common_app_parser.add_argument('--id', dest='app_id', metavar='ID', required=True)
 
     parser = argparse.ArgumentParser()
     subparsers = parser.add_subparsers()
     create_subparser = subparsers.add_parser('create', parents=[common_env_parser])
     create_subparser.add_argument('-b', '--blueprint', dest='blueprint_id', metavar='ID', required=True)
-    create_subparser.add_argument('-i', '--inputs', dest='inputs_file', metavar='FILE', required=True)
+    create_subparser.add_argument('-i', '--inputs', dest='inputs_file', metavar='FILE', required=True,
+                                  help="deployment inputs; JSON preferred, YAML accepted for .yaml/.yml files")
     create_subparser.add_argument('-o', '--outputs', dest='outputs_file', metavar='FILE', required=True)
     create_subparser.set_defaults(func=create)
     delete_subparser = subparsers.add_parser('delete', parents=[common_env_parser])
@@ -183,8 +395,7 @@ def main():
     uninstall_subparser.add_argument('--manager-id', metavar='ID', required=True)
     uninstall_subparser.set_defaults(func=uninstall)
 
-    with open(os.path.join(THIS_DIR, 'managers.yaml')) as f:
-        managers = yaml.safe_load(f)
+    managers = _load_managers()
 
     args = parser.parse_args()
     var_args = vars(args)